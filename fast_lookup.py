@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+"""
+fast_lookup.py — Numba-compiled IPv4 parsing and range matching kernels
+
+This module holds the hot inner loop of filter_ips.py. Instead of building a
+Python string and an ipaddress object for every input line, the input IP file
+is memory-mapped and indexed by line start/end offset arrays, and a
+Numba-compiled kernel parses each dotted-quad straight into an integer and
+binary-searches it against one table holding every country's collapsed
+network ranges, each range tagged with the countries it belongs to.
+
+The same parser also drives network collapsing: CIDR strings become integer
+ranges that are sorted, merged and split back into a minimal CIDR list.
+
+DATA LAYOUT:
+    - Input lines:    memory-mapped file bytes + int64 line start/end offsets
+    - Country ranges: sorted uint32 range starts/ends + an int32 tag per range
+    - Block index:    first range index per /16 block, so each binary search
+                      only covers the ranges of one /16
+
+REQUIREMENTS:
+    pip install numpy numba
+"""
+
+# =============================================================================
+# IMPORTS AND DEPENDENCIES
+# =============================================================================
+
+import os                               # File size checks
+import ipaddress                        # Network forms the compiled parser leaves out
+import mmap                             # Zero-copy access to the input file
+import tempfile                         # Sample input file for warm_up_kernels()
+import numpy as np                      # Contiguous array storage
+
+# =============================================================================
+# CRITICAL DEPENDENCY CHECK
+# =============================================================================
+
+try:
+    # Numba compiles the per-IP loop to native code and runs it outside the GIL;
+    # set_num_threads is re-exported so callers never import numba unchecked
+    from numba import njit, prange, set_num_threads
+except Exception as exc:
+    raise ImportError(
+        "CRITICAL: The Python package 'numba' is required.\n"
+        "It compiles the IP matching loop to native code.\n"
+        "Install it with: pip install numba\n"
+        f"Original error: {exc}"
+    )
+
+# =============================================================================
+# MATCH STATUS CODES
+# =============================================================================
+
+# Per-line codes returned by match_ips(); hits return their range tag (>= 0)
+NO_MATCH = -1       # Valid IPv4 line outside every range
+UNPARSED = -2       # Not a canonical IPv4 address/CIDR - caller must handle it
+
+# Address bits below the /16 block number used by build_block_index()
+BLOCK_SHIFT = 16
+
+# Sort key given by ip_sort_keys() to non-canonical lines (above any address)
+UNPARSED_SORT_KEY = 1 << 40
+
+# Per-line kinds returned by classify_lines()
+LINE_BLANK = 0      # Nothing but ASCII whitespace
+LINE_TEXT = 1       # Holds at least one non-whitespace ASCII byte
+LINE_NON_ASCII = 2  # ASCII whitespace and non-ASCII bytes only - caller must decode it
+
+# =============================================================================
+# BUFFER AND RANGE CONSTRUCTION
+# =============================================================================
+
+def split_lines(data):
+    """
+    Finds the start and end offset of every newline-separated line in a buffer.
+
+    Line i occupies data[starts[i]:ends[i]] (the '\\n' itself is excluded).
+    A final line without a trailing newline is included.
+
+    ARGS:
+        data (np.ndarray): uint8 view of the buffer
+
+    RETURNS:
+        tuple: (starts, ends) - np.int64 offset arrays
+    """
+    newlines = np.flatnonzero(data == 0x0A)
+    if data.size and data[-1] != 0x0A:
+        newlines = np.append(newlines, data.size)
+
+    starts = np.empty(newlines.size, dtype=np.int64)
+    starts[:1] = 0
+    starts[1:] = newlines[:-1] + 1
+
+    return starts, newlines.astype(np.int64)
+
+
+def encode_lines(lines):
+    """
+    Packs a list of text lines into a single contiguous buffer with offsets.
+
+    ARGS:
+        lines (list or np.ndarray): Text lines without trailing newlines
+
+    RETURNS:
+        tuple: (data, starts, ends) - np.uint8 view of the UTF-8 buffer and
+               np.int64 line start/end offsets (see split_lines)
+    """
+    if len(lines) == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    data = np.frombuffer(("\n".join(lines) + "\n").encode(), dtype=np.uint8)
+    return (data,) + split_lines(data)
+
+
+def load_ip_file_mmap(path):
+    """
+    Memory-maps an IP list file and indexes its non-blank lines.
+
+    The file is never copied into Python strings: the returned array is a
+    read-only view of the page cache, so forked workers share it for free.
+
+    ARGS:
+        path (str): Path of the input IP list
+
+    RETURNS:
+        tuple: (data, starts, ends) - np.uint8 view of the mapped file and
+               np.int64 start/end offsets of each line holding non-whitespace
+    """
+    with open(path, 'rb') as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            return encode_lines([])
+        data = np.frombuffer(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ),
+                             dtype=np.uint8)
+
+    starts, ends = split_lines(data)
+    kinds = classify_lines(data, starts, ends)
+
+    # str.strip() also removes Unicode whitespace (e.g. U+00A0), so lines with
+    # nothing but whitespace and non-ASCII bytes are decoded to decide
+    for i in np.flatnonzero(kinds == LINE_NON_ASCII):
+        if bytes(data[starts[i]:ends[i]]).decode(errors='replace').strip():
+            kinds[i] = LINE_TEXT
+
+    keep = kinds == LINE_TEXT
+    return data, starts[keep], ends[keep]
+
+
+def build_ranges(cidr_list):
+    """
+    Converts collapsed IPv4 CIDR strings into sorted start/end arrays.
+
+    ARGS:
+        cidr_list (list): Non-overlapping CIDR strings (output of collapse_networks)
+
+    RETURNS:
+        tuple: (starts, ends) - np.uint32 arrays sorted by range start
+    """
+    starts, ends, valid = parse_networks(*encode_lines(cidr_list))
+
+    order = np.argsort(starts[valid], kind='stable')
+    return (starts[valid][order].astype(np.uint32),
+            ends[valid][order].astype(np.uint32))
+
+
+def collapse_networks_np(network_strs):
+    """
+    Collapses IPv4 CIDR strings with array operations instead of ipaddress objects.
+
+    Networks are parsed to integer (start, end) ranges, sorted, merged in one
+    pass and split back into the minimal CIDR list - the same result as
+    ipaddress.collapse_addresses() without a Python object per network.
+    Strings the compiled parser rejects are retried with ipaddress, so
+    exactly the IPv4 networks ipaddress.ip_network() accepts are kept.
+
+    ARGS:
+        network_strs (list): CIDR network strings (e.g., ['1.2.3.0/24'])
+
+    RETURNS:
+        tuple: (collapsed_cidrs, valid_count) - collapsed CIDR strings and the
+               number of input strings that parsed as strict IPv4 networks
+    """
+    starts, ends, valid = parse_networks(*encode_lines(network_strs))
+
+    # Rare forms such as netmask or zero-padded prefixes ("1.2.3.0/255.255.255.0",
+    # "1.2.3.0/024") and junk lines take the slow path; real GeoIP data never does
+    for i in np.flatnonzero(~valid):
+        try:
+            network = ipaddress.ip_network(str(network_strs[i]).strip())
+        except ValueError:
+            continue
+        if network.version == 4:
+            starts[i] = int(network.network_address)
+            ends[i] = int(network.broadcast_address)
+            valid[i] = True
+
+    starts = starts[valid]
+    ends = ends[valid]
+    order = np.argsort(starts, kind='stable')
+    merged_starts, merged_ends = merge_ranges(starts[order], ends[order])
+    networks, prefixes, _ = ranges_to_cidrs(merged_starts, merged_ends)
+
+    return format_cidrs(networks, prefixes), len(starts)
+
+
+def format_cidrs(networks, prefixes):
+    """
+    Formats integer network addresses and prefix lengths as CIDR strings.
+
+    RETURNS:
+        list: CIDR strings (e.g., ['192.168.0.0/23'])
+    """
+    return [
+        f"{network >> 24}.{(network >> 16) & 255}.{(network >> 8) & 255}.{network & 255}/{prefix}"
+        for network, prefix in zip(networks.tolist(), prefixes.tolist())
+    ]
+
+
+def _sorted_unique(values):
+    """
+    Returns the sorted distinct values of a 1-D array.
+
+    Same result as np.unique(values), but a plain sort plus a neighbour
+    comparison; recent NumPy versions hash in np.unique, which is many
+    times slower on large integer arrays.
+    """
+    values = np.sort(values)
+    if values.size == 0:
+        return values
+
+    distinct = np.ones(values.size, dtype=bool)
+    distinct[1:] = values[1:] != values[:-1]
+    return values[distinct]
+
+
+def build_tagged_ranges(country_cidrs):
+    """
+    Combines several countries' collapsed CIDR lists into one tagged range table.
+
+    The address space is cut at every range boundary of every country; each
+    resulting segment is tagged with the set of countries covering it, and
+    neighbouring segments with the same set are merged again. Countries never
+    share addresses in GeoIP data, but the same country may be configured
+    twice, so membership is kept as a set rather than a single country.
+
+    ARGS:
+        country_cidrs (list): One collapsed CIDR list per country, in country order
+
+    RETURNS:
+        tuple: (starts, ends, tags, tag_countries) - disjoint sorted uint32
+               ranges, an int32 tag per range, and for each tag the tuple of
+               country indexes it stands for
+    """
+    country_count = len(country_cidrs)
+    country_ranges = [build_ranges(cidrs) for cidrs in country_cidrs]
+    country_ranges = [(k, starts.astype(np.int64), ends.astype(np.int64))
+                      for k, (starts, ends) in enumerate(country_ranges) if starts.size]
+
+    if not country_ranges:
+        empty = np.zeros(0, dtype=np.uint32)
+        return empty, empty, np.zeros(0, dtype=np.int32), []
+
+    # Elementary segments between consecutive boundaries of all countries
+    bounds = _sorted_unique(np.concatenate([starts for _, starts, _ in country_ranges] +
+                                           [ends + 1 for _, _, ends in country_ranges]))
+    segment_starts = bounds[:-1]
+    segment_ends = bounds[1:] - 1
+
+    # One bit per country: is the segment inside one of that country's ranges?
+    membership = np.zeros((segment_starts.size, (country_count + 7) // 8), dtype=np.uint8)
+    for k, starts, ends in country_ranges:
+        idx = np.searchsorted(starts, segment_starts, side='right') - 1
+        covered = (idx >= 0) & (segment_starts <= ends[np.maximum(idx, 0)])
+        membership[covered, k // 8] |= np.uint8(0x80 >> (k % 8))
+
+    # Distinct country sets become tags, numbered in sorted order. Up to 64
+    # countries, each bit row is read as one big-endian integer (same order
+    # as the rows), which sorts far faster than np.unique(axis=0) over rows
+    if membership.shape[1] <= 8:
+        padded = np.zeros((membership.shape[0], 8), dtype=np.uint8)
+        padded[:, :membership.shape[1]] = membership
+        row_keys = padded.view('>u8').reshape(-1).astype(np.uint64)
+        combo_keys = _sorted_unique(row_keys)
+        tags = np.searchsorted(combo_keys, row_keys)
+        combos = combo_keys.astype('>u8').view(np.uint8).reshape(-1, 8)
+    else:
+        combos, tags = np.unique(membership, axis=0, return_inverse=True)
+        tags = tags.reshape(-1)
+
+    # Uncovered gaps are dropped
+    covered = membership.any(axis=1)
+    segment_starts = segment_starts[covered]
+    segment_ends = segment_ends[covered]
+    tags = tags[covered]
+
+    # Re-merge touching segments that carry the same tag
+    first = np.ones(tags.size, dtype=bool)
+    first[1:] = (tags[1:] != tags[:-1]) | (segment_starts[1:] != segment_ends[:-1] + 1)
+    last = np.ones(tags.size, dtype=bool)
+    last[:-1] = first[1:]
+
+    tag_countries = [tuple(np.flatnonzero(np.unpackbits(combo)[:country_count]).tolist())
+                     for combo in combos]
+
+    return (segment_starts[first].astype(np.uint32),
+            segment_ends[last].astype(np.uint32),
+            tags[first].astype(np.int32),
+            tag_countries)
+
+
+def build_block_index(starts):
+    """
+    Indexes sorted range starts by their /16 block.
+
+    block_index[b] is the first range starting in /16 block b or later, so
+    the ranges starting inside block b are block_index[b]:block_index[b + 1].
+    The first lookup step is then a direct array read, and the binary search
+    only covers one block's ranges instead of the whole table - a few cache
+    lines instead of ~19 scattered reads.
+
+    ARGS:
+        starts (np.ndarray): Sorted uint32 range starts
+
+    RETURNS:
+        np.ndarray: int64 array of 65537 range indexes
+    """
+    block_count = 1 << (32 - BLOCK_SHIFT)
+    block_starts = np.arange(block_count + 1, dtype=np.int64) << BLOCK_SHIFT
+
+    return np.searchsorted(starts, block_starts).astype(np.int64)
+
+
+# =============================================================================
+# COMPILED KERNELS
+# =============================================================================
+
+@njit(cache=True)
+def _parse_ipv4_parts(buf, start, end):
+    """
+    Splits one ASCII line of buf[start:end] into its IPv4 address and prefix.
+
+    Accepts canonical dotted-quads ("1.2.3.4") and CIDRs ("1.2.3.0/24"),
+    surrounded by optional ASCII whitespace. Octets with leading zeros are
+    rejected, as ipaddress does.
+
+    RETURNS:
+        tuple: (address, prefix) - prefix is -1 when the line has no "/prefix";
+               address is UNPARSED (-2) if the line is anything else
+    """
+    # Trim surrounding whitespace (space, \t, \n, \v, \f, \r)
+    while start < end and (buf[start] == 32 or 9 <= buf[start] <= 13):
+        start += 1
+    while end > start and (buf[end - 1] == 32 or 9 <= buf[end - 1] <= 13):
+        end -= 1
+
+    address = 0
+    octet = 0
+    digits = 0
+    dots = 0
+    i = start
+
+    # Dotted-quad part: multiply-accumulate each octet, shift it in on '.'
+    while i < end:
+        char = buf[i]
+        if 48 <= char <= 57:
+            if digits == 1 and octet == 0:
+                return UNPARSED, -1
+            octet = octet * 10 + (char - 48)
+            digits += 1
+            if octet > 255:
+                return UNPARSED, -1
+        elif char == 46:
+            if digits == 0 or dots == 3:
+                return UNPARSED, -1
+            address = (address << 8) | octet
+            octet = 0
+            digits = 0
+            dots += 1
+        elif char == 47:
+            break
+        else:
+            return UNPARSED, -1
+        i += 1
+
+    if dots != 3 or digits == 0:
+        return UNPARSED, -1
+    address = (address << 8) | octet
+
+    if i == end:
+        return address, -1
+
+    # "/prefix" part: one or two digits, at most 32
+    i += 1
+    prefix = 0
+    prefix_digits = 0
+    while i < end:
+        char = buf[i]
+        if char < 48 or char > 57 or prefix_digits == 2:
+            return UNPARSED, -1
+        prefix = prefix * 10 + (char - 48)
+        prefix_digits += 1
+        i += 1
+    if prefix_digits == 0 or prefix > 32:
+        return UNPARSED, -1
+
+    return address, prefix
+
+
+@njit(cache=True)
+def parse_ipv4(buf, start, end):
+    """
+    Parses one ASCII line of buf[start:end] into an IPv4 lookup address.
+
+    CIDRs are reduced to their network address, matching
+    ipaddress.ip_network(..., strict=False).
+
+    RETURNS:
+        int: Address as an integer, or UNPARSED (-2) if the line is not IPv4
+    """
+    address, prefix = _parse_ipv4_parts(buf, start, end)
+    if address < 0 or prefix < 0:
+        return address
+
+    return address & ((0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF)
+
+
+@njit(cache=True)
+def parse_networks(lines_data, line_starts, line_ends):
+    """
+    Parses every line of the buffer as a strict prefix-length IPv4 CIDR.
+
+    Like ipaddress.ip_network(line) with its default strict=True, a bare
+    address is a /32 and a CIDR with host bits set is invalid. Only the
+    canonical "/prefix" form is accepted; netmask and zero-padded prefixes
+    are reported invalid (collapse_networks_np retries them with ipaddress).
+
+    RETURNS:
+        tuple: (starts, ends, valid) - int64 first/last address of each
+               network and a boolean validity flag per line
+    """
+    line_count = line_starts.size
+    starts = np.zeros(line_count, dtype=np.int64)
+    ends = np.zeros(line_count, dtype=np.int64)
+    valid = np.zeros(line_count, dtype=np.bool_)
+
+    for i in range(line_count):
+        address, prefix = _parse_ipv4_parts(lines_data, line_starts[i], line_ends[i])
+        if address < 0:
+            continue
+        if prefix < 0:
+            prefix = 32
+
+        host_mask = (1 << (32 - prefix)) - 1
+        if address & host_mask:
+            continue
+
+        starts[i] = address
+        ends[i] = address | host_mask
+        valid[i] = True
+
+    return starts, ends, valid
+
+
+@njit(cache=True)
+def ip_sort_keys(lines_data, line_starts, line_ends):
+    """
+    Computes a numeric sort key for every line of the buffer.
+
+    Lines order by address, then a bare address before its CIDRs by prefix
+    length. Each key stands for exactly one canonical IPv4 line, so equal
+    keys mean equal text; anything else, including a zero-padded prefix
+    such as "/08", gets UNPARSED_SORT_KEY and sorts after all addresses.
+
+    RETURNS:
+        np.ndarray: int64 key per line (address * 64 + prefix + 1, or
+                    UNPARSED_SORT_KEY)
+    """
+    line_count = line_starts.size
+    keys = np.empty(line_count, dtype=np.int64)
+
+    for i in range(line_count):
+        address, prefix = _parse_ipv4_parts(lines_data, line_starts[i], line_ends[i])
+        if address < 0:
+            keys[i] = UNPARSED_SORT_KEY
+            continue
+
+        if 0 <= prefix < 10:
+            # A one-digit prefix written with two digits has a leading zero
+            end = line_ends[i]
+            while lines_data[end - 1] == 32 or 9 <= lines_data[end - 1] <= 13:
+                end -= 1
+            if lines_data[end - 2] != 47:
+                keys[i] = UNPARSED_SORT_KEY
+                continue
+
+        keys[i] = address * 64 + prefix + 1
+
+    return keys
+
+
+@njit(cache=True)
+def merge_ranges(starts, ends):
+    """
+    Merges overlapping and adjacent ranges in a single pass.
+
+    ARGS:
+        starts (np.ndarray): int64 range starts, sorted ascending
+        ends (np.ndarray): int64 range ends aligned with starts
+
+    RETURNS:
+        tuple: (starts, ends) - disjoint, non-adjacent ranges in ascending order
+    """
+    merged_starts = np.empty(starts.size, dtype=np.int64)
+    merged_ends = np.empty(starts.size, dtype=np.int64)
+    count = 0
+
+    for i in range(starts.size):
+        if count > 0 and starts[i] <= merged_ends[count - 1] + 1:
+            # Overlaps or touches the current range - extend it
+            if ends[i] > merged_ends[count - 1]:
+                merged_ends[count - 1] = ends[i]
+        else:
+            merged_starts[count] = starts[i]
+            merged_ends[count] = ends[i]
+            count += 1
+
+    return merged_starts[:count], merged_ends[:count]
+
+
+@njit(cache=True)
+def ranges_to_cidrs(starts, ends):
+    """
+    Splits ranges back into the minimal list of CIDR blocks covering them.
+
+    At each step the block size is the largest power of two that both keeps
+    the current address aligned and fits in the remaining gap.
+
+    RETURNS:
+        tuple: (networks, prefixes, range_index) - int64 network addresses,
+               prefix lengths and the index of the range each block came from
+    """
+    # First pass only counts blocks so the output can be allocated exactly once
+    total = 0
+    for i in range(starts.size):
+        current = starts[i]
+        while current <= ends[i]:
+            size = current & -current if current else 1 << 32
+            while size > ends[i] - current + 1:
+                size >>= 1
+            total += 1
+            current += size
+
+    networks = np.empty(total, dtype=np.int64)
+    prefixes = np.empty(total, dtype=np.int64)
+    range_index = np.empty(total, dtype=np.int64)
+    count = 0
+    for i in range(starts.size):
+        current = starts[i]
+        while current <= ends[i]:
+            size = current & -current if current else 1 << 32
+            while size > ends[i] - current + 1:
+                size >>= 1
+            prefix = 32
+            while size >> (32 - prefix) > 1:
+                prefix -= 1
+            networks[count] = current
+            prefixes[count] = prefix
+            range_index[count] = i
+            count += 1
+            current += size
+
+    return networks, prefixes, range_index
+
+
+@njit(cache=True)
+def classify_lines(lines_data, line_starts, line_ends):
+    """
+    Tells blank lines from lines holding text, one pass over each line.
+
+    Whitespace is the ASCII set str.strip() removes. Lines made only of that
+    whitespace and non-ASCII bytes are reported as LINE_NON_ASCII, since
+    whether they are blank depends on how their UTF-8 text decodes.
+
+    ARGS:
+        lines_data (np.ndarray): uint8 view of the line buffer
+        line_starts (np.ndarray): int64 start offset of each line
+        line_ends (np.ndarray): int64 end offset of each line
+
+    RETURNS:
+        np.ndarray: int8 kind of each line (LINE_BLANK, LINE_TEXT or LINE_NON_ASCII)
+    """
+    kinds = np.empty(line_starts.size, dtype=np.int8)
+    for i in range(line_starts.size):
+        kind = LINE_BLANK
+        for pos in range(line_starts[i], line_ends[i]):
+            byte = lines_data[pos]
+            # Same whitespace set as str.strip(): \t\n\v\f\r, \x1c-\x1f and space
+            if 9 <= byte <= 13 or 28 <= byte <= 32:
+                continue
+            if byte >= 128:
+                kind = LINE_NON_ASCII
+                continue
+            kind = LINE_TEXT
+            break
+        kinds[i] = kind
+
+    return kinds
+
+
+@njit(cache=True)
+def gather_lines(lines_data, line_starts, line_ends):
+    """
+    Copies the given lines of the buffer into one newline-terminated block.
+
+    Surrounding ASCII whitespace is trimmed from each line, matching what
+    str.strip() removes for ASCII text, so the block decodes and splits into
+    the same strings the per-line Python path produced.
+
+    ARGS:
+        lines_data (np.ndarray): uint8 view of the line buffer
+        line_starts (np.ndarray): int64 start offset of each line to copy
+        line_ends (np.ndarray): int64 end offset of each line to copy
+
+    RETURNS:
+        np.ndarray: uint8 buffer holding each trimmed line followed by '\\n'
+    """
+    total = 0
+    for i in range(line_starts.size):
+        total += line_ends[i] - line_starts[i] + 1
+
+    block = np.empty(total, dtype=np.uint8)
+    pos = 0
+    for i in range(line_starts.size):
+        start = line_starts[i]
+        end = line_ends[i]
+        # Same whitespace set as str.strip(): \t\n\v\f\r, \x1c-\x1f and space
+        while start < end and (9 <= lines_data[start] <= 13 or 28 <= lines_data[start] <= 32):
+            start += 1
+        while end > start and (9 <= lines_data[end - 1] <= 13 or 28 <= lines_data[end - 1] <= 32):
+            end -= 1
+        block[pos:pos + end - start] = lines_data[start:end]
+        pos += end - start
+        block[pos] = 10
+        pos += 1
+
+    return block[:pos]
+
+
+@njit(cache=True, parallel=True)
+def match_ips(lines_data, line_starts, line_ends, starts, ends, tags, block_index):
+    """
+    Parses the given lines of the buffer and looks them up in the tagged ranges.
+
+    ARGS:
+        lines_data (np.ndarray): uint8 view of the line buffer
+        line_starts (np.ndarray): int64 start offset of each line to check
+        line_ends (np.ndarray): int64 end offset of each line to check
+        starts (np.ndarray): Sorted uint32 range starts
+        ends (np.ndarray): uint32 range ends aligned with starts
+        tags (np.ndarray): int32 tag of each range (see build_tagged_ranges)
+        block_index (np.ndarray): Range index per /16 block (see build_block_index)
+
+    RETURNS:
+        np.ndarray: int32 per line - the matching range's tag, NO_MATCH or UNPARSED
+    """
+    line_count = line_starts.size
+    line_tags = np.empty(line_count, dtype=np.int32)
+
+    for i in prange(line_count):
+        ip = parse_ipv4(lines_data, line_starts[i], line_ends[i])
+        if ip < 0:
+            line_tags[i] = UNPARSED
+            continue
+
+        # Last range starting at or before the IP is the only candidate: search
+        # the ranges starting in its /16, or take the one before them
+        block = ip >> BLOCK_SHIFT
+        first = block_index[block]
+        last = block_index[block + 1]
+        idx = first + np.searchsorted(starts[first:last], np.uint32(ip), side='right') - 1
+        if idx >= 0 and ip <= ends[idx]:
+            line_tags[i] = tags[idx]
+        else:
+            line_tags[i] = NO_MATCH
+
+    return line_tags
+
+
+# =============================================================================
+# CACHE WARM-UP
+# =============================================================================
+
+def warm_up_kernels():
+    """
+    Compiles every kernel into the Numba cache ahead of the first real run.
+
+    The kernels are driven through the same entry points filter_ips.py uses
+    (mapped input file, collapsed CIDR lists including an empty country,
+    a combined output block), so the cached signatures are exactly the ones
+    a run needs. The Docker build calls this so runs start from a warm cache.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.txt') as sample_file:
+        sample_file.write(b"1.2.3.4\n\n5.6.7.0/24\n")
+        sample_file.flush()
+        lines_data, line_starts, line_ends = load_ip_file_mmap(sample_file.name)
+
+    country_cidrs = [collapse_networks_np(["1.2.3.0/24", "1.2.2.0/24"])[0], []]
+    starts, ends, tags, _ = build_tagged_ranges(country_cidrs)
+    block_index = build_block_index(starts)
+
+    line_tags = match_ips(lines_data, line_starts, line_ends, starts, ends, tags, block_index)
+    matched_lines = np.flatnonzero(line_tags >= 0)
+    ip_block = gather_lines(lines_data, line_starts[matched_lines], line_ends[matched_lines])
+
+    block_data = np.frombuffer(ip_block.tobytes(), dtype=np.uint8)
+    block_starts, block_ends = split_lines(block_data)
+    ip_sort_keys(block_data, block_starts, block_ends)
+    gather_lines(block_data, block_starts[:1], block_ends[:1])
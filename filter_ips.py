@@ -2,9 +2,10 @@
 """
 filter_ips.py — Enhanced Multi-Country GeoIP-based IP Address Filtering Tool
 
-This script filters IP addresses by multiple countries using GeoIP data and Zeek's SubnetTree
-for efficient network lookups. It processes large IP lists in parallel batches
-while preserving original formatting (including CIDR notation).
+This script filters IP addresses by multiple countries using GeoIP data, a
+Numba-compiled IPv4 range matcher (fast_lookup.py), with an ipaddress-based
+fallback for lines the fast matcher cannot parse. It processes large IP lists in parallel
+batches while preserving original formatting (including CIDR notation).
 
 NEW MULTI-COUNTRY FEATURES:
     - Supports multiple COUNTRY_ISO_CODE_N and COUNTRY_NAME_N variables
@@ -13,11 +14,12 @@ NEW MULTI-COUNTRY FEATURES:
     - Enhanced statistics reporting with Mermaid pie charts
 
 REQUIREMENTS:
-    pip install pysubnettree pandas python-dotenv requests
+    pip install python-dotenv requests numpy numba
+    pip install pyarrow   # optional, faster GeoIP CSV parsing
 
 MAIN WORKFLOW:
     1. Load configuration from environment variables (.env file)
-    2. Download GeoIP CSV data if not present locally
+    2. Download GeoIP CSV data, or refresh it only if upstream changed
     3. Dynamically detect all COUNTRY_* variables
     4. Filter GeoIP networks by all target countries
     5. Process each country separately with optimized networks
@@ -33,31 +35,40 @@ import os                               # Operating system interface
 import logging                          # Logging functionality
 import ipaddress                        # IP address manipulation and validation
 from pathlib import Path                # Modern path handling
-from concurrent.futures import ProcessPoolExecutor  # Parallel processing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor  # Parallel processing
 import multiprocessing as mp            # Multiprocessing utilities
 from dotenv import load_dotenv          # Environment variable loading
-import shutil                           # High-level file operations
-import pandas as pd                     # Data manipulation and analysis
+import csv                              # GeoIP CSV reading when pyarrow is missing
 import requests                         # HTTP requests for downloading data
 import re                              # Regular expressions for pattern matching
+import hashlib                          # Cache keys for collapsed country networks
+import gzip                             # Compressed storage of the downloaded GeoIP CSV
+import zlib                             # Decompression errors from corrupt GeoIP archives
+import time                             # Batch timing for batch size calibration
+import itertools                        # Chaining the calibration result with batch results
+from datetime import datetime, timezone  # Statistics timestamp
+from email.utils import formatdate, parsedate_to_datetime  # HTTP dates for GeoIP refresh checks
+import pickle                           # On-disk cache of collapsed country networks
+import numpy as np                      # Contiguous arrays for the fast matcher
+from fast_lookup import (               # Compiled IPv4 parsing and range matching
+    build_block_index, build_tagged_ranges, collapse_networks_np, gather_lines,
+    ip_sort_keys, load_ip_file_mmap, match_ips, set_num_threads, split_lines,
+    NO_MATCH, UNPARSED, UNPARSED_SORT_KEY
+)
 
 # =============================================================================
-# CRITICAL DEPENDENCY CHECK
+# OPTIONAL DEPENDENCY CHECK
 # =============================================================================
 
 try:
-    # SubnetTree is the core component for efficient IP network lookups
-    # It provides O(log n) lookup time instead of O(n) for linear searches
-    import SubnetTree
-except Exception as exc:
-    # If SubnetTree is missing, the script cannot function efficiently
-    # Provide clear installation instructions and exit gracefully
-    raise ImportError(
-        "CRITICAL: The Python package 'pysubnettree' (module name 'SubnetTree') is required.\n"
-        "This package provides efficient IP network lookups using a tree data structure.\n"
-        "Install it with: pip install pysubnettree\n"
-        f"Original error: {exc}"
-    )
+    # pyarrow reads the GeoIP CSV multithreaded straight into a columnar table
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pc
+    HAS_PYARROW = True
+except ImportError:
+    # Without it the GeoIP CSV is streamed through the csv module instead
+    HAS_PYARROW = False
 
 # =============================================================================
 # CONFIGURATION AND ENVIRONMENT SETUP
@@ -69,7 +80,12 @@ load_dotenv()
 
 # FILE PATH CONFIGURATION
 # Define where input and output files are located
-GEOIP_CSV_PATH = os.getenv('GEOIP_CSV_PATH', '/data/geoip/geoip2-ipv4.csv')
+GEOIP_CSV_DEFAULT_PATH = '/data/geoip/geoip2-ipv4.csv'
+GEOIP_CSV_PATH = os.getenv('GEOIP_CSV_PATH', GEOIP_CSV_DEFAULT_PATH)
+
+# Downloads are stored gzip-compressed next to the configured path; a plain
+# CSV at GEOIP_CSV_PATH itself is still used when no compressed copy exists
+GEOIP_CSV_GZ_PATH = f"{GEOIP_CSV_PATH}.gz"
 ALL_IPS_FROM_LISTS = os.getenv('ALL_IPS_FROM_LISTS', '/data/output/aggregated.txt')
 
 # PERFORMANCE TUNING
@@ -78,18 +94,74 @@ ALL_IPS_FROM_LISTS = os.getenv('ALL_IPS_FROM_LISTS', '/data/output/aggregated.tx
 NUM_WORKERS_ENV = os.getenv('NUM_WORKERS')
 NUM_WORKERS_OVERRIDE = max(1, int(NUM_WORKERS_ENV)) if NUM_WORKERS_ENV else None
 
+# Without an override, start one worker per MIN_IPS_PER_WORKER input lines
+# (up to the CPU count) so small inputs don't pay for idle forked workers
+MIN_IPS_PER_WORKER = 25_000
+
+# Without an override, inputs with fewer lines than this are matched in the
+# main process: forking a pool and calibrating it would take longer than the scan
+INLINE_MAX_IPS = 100_000
+
+# Batch sizing: the first CALIBRATION_LINES input lines are timed in a worker,
+# and the remaining batches are sized to take about BATCH_TARGET_SECONDS each
+CALIBRATION_LINES = 10_000
+BATCH_TARGET_SECONDS = 0.075
+MIN_BATCH_LINES = 1_000
+MAX_BATCH_LINES = 500_000
+
+# DEBUG LOGGING
+# Per-IP and per-network debug messages are only built when this is set;
+# otherwise the hot loops skip the f-string formatting and logger calls entirely
+_DEBUG = os.getenv('FILTER_IPS_DEBUG') == '1'
+
+# CACHE CONFIGURATION
+# Collapsed per-country networks are cached here, keyed by the GeoIP data and
+# the country configuration, so unchanged inputs skip CSV parsing and collapsing
+GEOIP_CACHE_DIR = os.getenv('GEOIP_CACHE_DIR', '/data/cache')
+
+# Part of the cache key; bump it whenever parsing, filtering or collapsing
+# changes, so cache files written by older code are never loaded
+CACHE_FORMAT_VERSION = 2
+
 # =============================================================================
 # GLOBAL WORKER VARIABLE
 # =============================================================================
 
-# This global variable holds the SubnetTree instance in each worker process
-# It's initialized once per worker and then used for all IP lookups in that worker
-WORKER_TREE = None
+# These globals hold the combined all-country lookup structures. They are built
+# once in the main process; forked workers inherit them without any pickling,
+# and spawn-based workers rebuild them in _init_worker.
+
+# Tagged range arrays for the compiled matcher (see build_tagged_ranges)
+WORKER_STARTS = None
+WORKER_ENDS = None
+WORKER_TAGS = None
+
+# First range index of each /16 block (see build_block_index)
+WORKER_BLOCK_INDEX = None
+
+# For each tag, the tuple of country indexes it stands for, and the same
+# as a boolean (tag x country) matrix for vectorized dispatch
+WORKER_TAG_COUNTRIES = None
+WORKER_TAG_MASK = None
+
+# Number of configured countries (length of each batch result)
+WORKER_COUNTRY_COUNT = 0
+
+# Memory-mapped input file: uint8 view plus the start/end offset of each line
+# Batches are (first, last) line index ranges into these arrays
+WORKER_INPUT = None
+WORKER_LINE_STARTS = None
+WORKER_LINE_ENDS = None
 
 # =============================================================================
 # COUNTRY CONFIGURATION DETECTION
 # =============================================================================
 
+# Matches COUNTRY_ISO_CODE (legacy) and COUNTRY_ISO_CODE_1, _10, _999, etc.
+# Group 1 is the numeric suffix, None for the legacy unnumbered variable
+_ISO_RE = re.compile(r'^COUNTRY_ISO_CODE(?:_(\d+))?$')
+
+
 def detect_country_configs():
     """
     Dynamically detect all COUNTRY_ISO_CODE_* and COUNTRY_NAME_* variables from environment.
@@ -111,64 +183,41 @@ def detect_country_configs():
             
         Returns: [('US', 'United States', '1'), ('CA', 'Canada', '2'), ('DE', 'Germany', '15')]
     """
-    countries = []
-    
-    # Get all environment variables
-    env_vars = dict(os.environ)
-    
     # Debug: Log all COUNTRY_ variables found
-    country_vars = {k: v for k, v in env_vars.items() if k.startswith('COUNTRY_')}
+    country_vars = {k: v for k, v in os.environ.items() if k.startswith('COUNTRY_')}
     logging.info(f"Found {len(country_vars)} COUNTRY_ variables in environment")
     
-    # More flexible regex pattern that catches all numbered variations
-    # This will match: COUNTRY_ISO_CODE_1, COUNTRY_ISO_CODE_10, COUNTRY_ISO_CODE_999, etc.
-    iso_code_pattern = re.compile(r'^COUNTRY_ISO_CODE(_)?(\d*)$')
-    
-    # Find all COUNTRY_ISO_CODE variables (including legacy COUNTRY_ISO_CODE without number)
-    for var_name, var_value in env_vars.items():
-        match = iso_code_pattern.match(var_name)
-        if match:
-            # Handle both legacy (no number) and numbered formats
-            has_underscore = match.group(1) is not None
-            number_part = match.group(2)
-            
-            if has_underscore and number_part:
-                # Format: COUNTRY_ISO_CODE_123
-                suffix = number_part
-                suffix_with_underscore = f"_{suffix}"
-            elif not has_underscore and not number_part:
-                # Format: COUNTRY_ISO_CODE (legacy)
-                suffix = ""
-                suffix_with_underscore = ""
-            else:
-                # Skip malformed patterns like COUNTRY_ISO_CODE_ (underscore but no number)
-                logging.debug(f"Skipping malformed country variable: {var_name}")
-                continue
-            
-            iso_code = var_value.strip().upper()  # Normalize to uppercase
-            
-            # Find corresponding COUNTRY_NAME variable
-            name_var = f"COUNTRY_NAME{suffix_with_underscore}"
-            country_name = env_vars.get(name_var, f"Unknown-{iso_code}").strip()
-            
-            if iso_code:  # Only add if ISO code is not empty
-                countries.append((iso_code, country_name, suffix))
-                logging.info(f"Detected country config: {iso_code} ({country_name}) [suffix: '{suffix or 'legacy'}']")
-            else:
-                logging.warning(f"Empty ISO code found in {var_name}")
+    # Single pass over the COUNTRY_ variables with the precompiled pattern:
+    # (match, variable name, normalized ISO code) for every ISO code variable
+    iso_matches = [
+        (match, var_name, var_value.strip().upper())
+        for var_name, var_value in country_vars.items()
+        if (match := _ISO_RE.match(var_name))
+    ]
+    
+    # Suffix is the number for COUNTRY_ISO_CODE_123, empty for legacy COUNTRY_ISO_CODE;
+    # the name comes from the COUNTRY_NAME variable with the same suffix
+    countries = [
+        (
+            iso_code,
+            country_vars.get(
+                f"COUNTRY_NAME_{match.group(1)}" if match.group(1) else "COUNTRY_NAME",
+                f"Unknown-{iso_code}"
+            ).strip(),
+            match.group(1) or ""
+        )
+        for match, var_name, iso_code in iso_matches
+        if iso_code  # Only add if ISO code is not empty
+    ]
+    
+    for var_name in (var_name for _, var_name, iso_code in iso_matches if not iso_code):
+        logging.warning(f"Empty ISO code found in {var_name}")
     
     # Sort by suffix for consistent ordering (legacy first, then by number)
-    def sort_key(country_tuple):
-        _, _, suffix = country_tuple
-        if suffix == "":
-            return (0, 0)  # Legacy comes first
-        else:
-            try:
-                return (1, int(suffix))  # Then by number
-            except ValueError:
-                return (2, suffix)  # Non-numeric suffixes last, sorted alphabetically
+    countries.sort(key=lambda country: (0, 0) if country[2] == "" else (1, int(country[2])))
     
-    countries.sort(key=sort_key)
+    for iso_code, country_name, suffix in countries:
+        logging.info(f"Detected country config: {iso_code} ({country_name}) [suffix: '{suffix or 'legacy'}']")
     
     if not countries:
         logging.error("No COUNTRY_ISO_CODE variables found in environment!")
@@ -186,11 +235,12 @@ def detect_country_configs():
         logging.info(f"Total countries detected: {len(countries)}")
         
         # Validate that we have both ISO codes and names for each
-        missing_names = []
-        for iso_code, country_name, suffix in countries:
-            if country_name.startswith("Unknown-"):
-                missing_names.append(f"COUNTRY_NAME_{suffix}" if suffix else "COUNTRY_NAME")
-        
+        missing_names = [
+            f"COUNTRY_NAME_{suffix}" if suffix else "COUNTRY_NAME"
+            for _, country_name, suffix in countries
+            if country_name.startswith("Unknown-")
+        ]
+
         if missing_names:
             logging.warning(f"Missing country name variables: {', '.join(missing_names)}")
     
@@ -200,9 +250,23 @@ def detect_country_configs():
 # GEOIP DATA MANAGEMENT FUNCTIONS
 # =============================================================================
 
+def geoip_csv_file():
+    """
+    Returns the GeoIP CSV file to read: the compressed download if present,
+    otherwise the plain CSV at GEOIP_CSV_PATH.
+    
+    RETURNS:
+        str or None: Path of the existing GeoIP file, None if neither exists
+    """
+    for candidate_path in (GEOIP_CSV_GZ_PATH, GEOIP_CSV_PATH):
+        if os.path.exists(candidate_path):
+            return candidate_path
+    return None
+
+
 def download_geoip_file():
     """
-    Downloads GeoIP2 IPv4 CSV data if not already present locally.
+    Downloads GeoIP2 IPv4 CSV data, or refreshes a previous download.
     
     This function handles the automatic acquisition of GeoIP data, which maps
     IP address ranges to countries. The data is essential for country-based
@@ -213,62 +277,129 @@ def download_geoip_file():
         - Contains: network, country_iso_code, country_name columns
         - Format: CIDR networks with country mappings
     
+    STORAGE:
+        - The response is streamed in 1 MB chunks and gzip-compressed on the
+          fly into GEOIP_CSV_GZ_PATH, so memory use stays flat
+        - The gzip header carries no timestamp, so identical data always
+          produces identical bytes (and the same network cache key)
+        - Written to a temporary file and renamed once complete
+        - The file's mtime is set to the server's Last-Modified time
+    
+    REFRESH:
+        - A previous download is kept between runs and only fetched again
+          if the server reports a newer copy (If-Modified-Since → 304)
+        - A plain CSV at the default path is checked the same way, since
+          older versions of this script downloaded there; once a newer copy
+          is downloaded, the plain CSV is removed
+        - A plain CSV at a custom GEOIP_CSV_PATH is the user's own data and
+          is used as-is, never refreshed
+    
     ERROR HANDLING:
         - Creates parent directories if they don't exist
         - Validates HTTP response status
-        - Exits gracefully if download fails
+        - Keeps the previous download if the refresh check or the write fails
+        - Exits gracefully if there is no GeoIP data at all
     
     SIDE EFFECTS:
         - Creates directories on filesystem
         - Downloads and writes CSV file
         - May raise SystemExit on failure
     """
-    # Check if the GeoIP CSV file already exists on disk
-    if not os.path.exists(GEOIP_CSV_PATH):
+    # A plain CSV at a custom path was supplied by the user and is never refreshed
+    existing_path = geoip_csv_file()
+    if existing_path == GEOIP_CSV_PATH and GEOIP_CSV_PATH != GEOIP_CSV_DEFAULT_PATH:
+        logging.info(f"GeoIP file already exists at {existing_path} (custom path, not refreshed)")
+        return
+    
+    # DataHub provides free, regularly updated GeoIP data
+    url = "https://datahub.io/core/geoip2-ipv4/r/geoip2-ipv4.csv"
+    temp_path = f"{GEOIP_CSV_GZ_PATH}.part"
+    request_headers = {}
+    
+    if existing_path is None:
         logging.info(f"GeoIP file not found at {GEOIP_CSV_PATH}. Initiating download...")
-        
-        # DataHub provides free, regularly updated GeoIP data
-        url = "https://datahub.io/core/geoip2-ipv4/r/geoip2-ipv4.csv"
-        
-        try:
-            # Download the CSV file with a reasonable timeout
-            logging.info("Downloading GeoIP2 CSV data from DataHub...")
-            response = requests.get(url, timeout=60)
+    else:
+        # Ask for the file only if it changed since our copy was published
+        logging.info(f"GeoIP file found at {existing_path}. Checking for updates...")
+        request_headers['If-Modified-Since'] = formatdate(os.path.getmtime(existing_path), usegmt=True)
+    
+    try:
+        # Stream the CSV file with a reasonable timeout
+        logging.info("Downloading GeoIP2 CSV data from DataHub...")
+        with requests.get(url, stream=True, timeout=60, headers=request_headers) as response:
+            
+            if response.status_code == 304:
+                logging.info("GeoIP file is up to date")
+                return
             
             # Check if the download was successful
-            if response.status_code == 200:
-                # Create parent directories if they don't exist
-                # This ensures the full path structure is available
-                Path(GEOIP_CSV_PATH).parent.mkdir(parents=True, exist_ok=True)
-                
-                # Write the downloaded content to disk
-                with open(GEOIP_CSV_PATH, 'wb') as file_handle:
-                    file_handle.write(response.content)
-                
-                logging.info("GeoIP2 CSV file downloaded and saved successfully.")
-            else:
-                # Log the specific HTTP error and exit
+            if response.status_code != 200:
+                # Log the specific HTTP error; without any data we cannot go on
                 logging.error(f"Download failed with HTTP status: {response.status_code}")
+                if existing_path is not None:
+                    logging.warning(f"Keeping existing GeoIP file at {existing_path}")
+                    return
                 logging.error("Cannot proceed without GeoIP data. Exiting.")
                 raise SystemExit(1)
-                
-        except requests.exceptions.RequestException as req_exc:
-            # Handle network-related errors (timeouts, connection issues, etc.)
-            logging.error(f"Network error during download: {req_exc}")
-            raise SystemExit(1)
             
-    else:
-        logging.info(f"GeoIP file already exists at {GEOIP_CSV_PATH}")
+            # Create parent directories if they don't exist
+            # This ensures the full path structure is available
+            Path(GEOIP_CSV_GZ_PATH).parent.mkdir(parents=True, exist_ok=True)
+            
+            # Compress chunks to disk as they arrive instead of buffering the body
+            with gzip.GzipFile(temp_path, 'wb', compresslevel=6, mtime=0) as file_handle:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    file_handle.write(chunk)
+            
+            last_modified = response.headers.get('Last-Modified')
+        
+        os.replace(temp_path, GEOIP_CSV_GZ_PATH)
+        logging.info(f"GeoIP2 CSV file downloaded and saved successfully to {GEOIP_CSV_GZ_PATH}.")
+        
+        # The new download replaces a plain CSV left at the default path
+        if existing_path == GEOIP_CSV_PATH:
+            try:
+                os.remove(existing_path)
+                logging.info(f"Removed outdated GeoIP file {existing_path}")
+            except OSError as remove_error:
+                logging.warning(f"Failed to remove outdated GeoIP file {existing_path}: {remove_error}")
+        
+        # Stamp the file with the server's time so the next check compares like with like
+        if last_modified:
+            try:
+                published_time = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(GEOIP_CSV_GZ_PATH, (published_time, published_time))
+            except (TypeError, ValueError):
+                logging.warning(f"Ignoring unparsable Last-Modified header: {last_modified}")
+            
+    except requests.exceptions.RequestException as req_exc:
+        # Handle network-related errors (timeouts, connection issues, etc.)
+        logging.error(f"Network error during download: {req_exc}")
+        Path(temp_path).unlink(missing_ok=True)
+        if existing_path is not None:
+            logging.warning(f"Keeping existing GeoIP file at {existing_path}")
+            return
+        raise SystemExit(1)
+    except OSError as write_error:
+        # Handle disk errors while writing the compressed file
+        logging.error(f"Failed to write GeoIP file: {write_error}")
+        Path(temp_path).unlink(missing_ok=True)
+        if existing_path is not None:
+            logging.warning(f"Keeping existing GeoIP file at {existing_path}")
+            return
+        raise SystemExit(1)
 
 
 def collapse_networks(network_strs):
     """
     Optimizes network lists by collapsing overlapping and adjacent networks.
     
-    This function takes a list of CIDR network strings and uses Python's
-    ipaddress module to combine overlapping or adjacent networks into larger,
-    more efficient blocks. This reduces the number of networks that need to
-    be stored in the SubnetTree, improving both memory usage and lookup speed.
+    This function takes a list of CIDR network strings and combines overlapping
+    or adjacent networks into larger, more efficient blocks. The work is done
+    on integer ranges by collapse_networks_np() (sort, single-pass merge, split
+    back to CIDRs) rather than on one ipaddress object per network. This reduces
+    the number of ranges that need to be searched, improving both memory usage
+    and lookup speed.
     
     ARGS:
         network_strs (list): List of CIDR network strings (e.g., ['1.2.3.0/24'])
@@ -277,213 +408,295 @@ def collapse_networks(network_strs):
         list: Collapsed network strings with overlaps removed
     
     EXAMPLE:
-        Input:  ['192.168.1.0/24', '192.168.2.0/24']
+        Input:  ['192.168.0.0/24', '192.168.1.0/24']
         Output: ['192.168.0.0/23']  # Combined into larger block
     
     OPTIMIZATION BENEFITS:
-        - Reduces memory footprint in SubnetTree
+        - Reduces memory footprint of the lookup structures
         - Improves lookup performance
         - Eliminates redundant network checks
     """
-    network_objects = []
-    invalid_count = 0
-    
-    # Convert string representations to ipaddress network objects
-    for network_str in network_strs:
-        try:
-            # Create network object from CIDR string
-            # strip() removes any whitespace that might cause parsing errors
-            network_obj = ipaddress.ip_network(network_str.strip())
-            network_objects.append(network_obj)
-        except (ipaddress.AddressValueError, ipaddress.NetmaskValueError, ValueError) as parse_error:
-            # Log invalid networks for debugging but continue processing
-            invalid_count += 1
-            logging.debug(f"Skipping invalid network '{network_str}': {parse_error}")
-            continue
+    # Parse, merge and re-split all networks in compiled code
+    collapsed_networks, original_count = collapse_networks_np(network_strs)
     
     # Report parsing results
+    invalid_count = len(network_strs) - original_count
     if invalid_count > 0:
         logging.warning(f"Skipped {invalid_count} invalid network entries")
     
-    # Use ipaddress.collapse_addresses() to merge overlapping/adjacent networks
-    # This is a built-in Python optimization that's highly efficient
-    collapsed_networks = list(ipaddress.collapse_addresses(network_objects))
-    
     # Log the optimization results
-    original_count = len(network_objects)
     collapsed_count = len(collapsed_networks)
     reduction_percent = ((original_count - collapsed_count) / original_count * 100) if original_count > 0 else 0
     
     logging.info(f"Network optimization: {original_count} → {collapsed_count} "
                 f"({reduction_percent:.1f}% reduction)")
     
-    # Convert back to string format for SubnetTree compatibility
-    return [str(network) for network in collapsed_networks]
+    return collapsed_networks
 
 
 # =============================================================================
 # PARALLEL PROCESSING WORKER FUNCTIONS
 # =============================================================================
 
-def _init_worker(cidr_list):
+def _install_lookup(country_cidrs):
     """
-    Initializes each worker process with a SubnetTree containing country networks.
-    
-    This function is called once when each worker process starts up. It builds
-    a SubnetTree data structure from the provided CIDR list, which enables
-    extremely fast IP lookups (O(log n) instead of O(n) for linear searches).
+    Builds the combined all-country lookup structures into the worker globals.
     
-    PROCESS DESIGN:
-        - Each worker gets its own copy of the SubnetTree
-        - Tree is built once per worker and reused for all lookups
-        - Global variable stores the tree for access by batch processing function
+    Every country's collapsed CIDRs go into ONE tagged range table, so each
+    input IP is looked up once no matter how many countries are configured.
+    The per-line fallback path searches the same arrays.
     
     ARGS:
-        cidr_list (list): List of CIDR strings to add to the SubnetTree
+        country_cidrs (list): One collapsed CIDR list per country, in country order
     
     SIDE EFFECTS:
-        - Sets global WORKER_TREE variable in the worker process
-        - Imports SubnetTree in worker context
-        - May log errors for malformed CIDRs but continues processing
+        - Sets the WORKER_* globals in the calling process
     
     PERFORMANCE NOTES:
-        - SubnetTree construction is O(n log n)
-        - Lookup operations are O(log n)
-        - Memory usage scales with number of networks
+        - Built once per run (not once per country per worker)
+        - Range lookups are a binary search, O(log n), within one /16 block
     """
-    global WORKER_TREE
+    global WORKER_STARTS, WORKER_ENDS, WORKER_TAGS, WORKER_BLOCK_INDEX
+    global WORKER_TAG_COUNTRIES, WORKER_TAG_MASK, WORKER_COUNTRY_COUNT
+    
+    range_starts, range_ends, range_tags, tag_countries = build_tagged_ranges(country_cidrs)
+    
+    # Store the completed lookup structures in the global variables
+    WORKER_STARTS = range_starts
+    WORKER_ENDS = range_ends
+    WORKER_TAGS = range_tags
+    WORKER_BLOCK_INDEX = build_block_index(range_starts)
+    WORKER_TAG_COUNTRIES = tag_countries
+    WORKER_COUNTRY_COUNT = len(country_cidrs)
+    WORKER_TAG_MASK = np.zeros((len(tag_countries), len(country_cidrs)), dtype=bool)
+    for range_tag, country_indexes in enumerate(tag_countries):
+        WORKER_TAG_MASK[range_tag, list(country_indexes)] = True
     
-    # Import SubnetTree in the worker process context
-    # This ensures the module is available in each worker's memory space
-    import SubnetTree as WorkerSubnetTree
+    # Log initialization results
+    if _DEBUG:
+        logging.debug(f"Lookup built: {len(range_starts)} tagged ranges for "
+                      f"{len(country_cidrs)} countries ({len(tag_countries)} tags)")
+
+
+def _init_worker(country_cidrs):
+    """
+    Initializes each worker process with the combined country lookup.
     
-    # Create a new SubnetTree instance for this worker
-    subnet_tree = WorkerSubnetTree.SubnetTree()
+    This function is called once when each worker process starts up. With the
+    'fork' start method the lookup and the memory-mapped input built by the
+    main process are inherited as-is; with 'spawn' the worker starts empty,
+    builds the lookup from the CIDR lists and maps the input file itself.
     
-    # Track statistics for logging
-    added_count = 0
-    error_count = 0
+    PROCESS DESIGN:
+        - Lookup structures are shared copy-on-write when forked
+        - Global variables store them for access by batch processing function
+        - Numba is limited to one thread per worker since the pool already
+          spreads batches across processes
     
-    # Add each CIDR network to the tree
-    for cidr_string in cidr_list:
-        try:
-            # Add the network to the tree with value True
-            # The value (True) indicates this network matches our country filter
-            subnet_tree[cidr_string] = True
-            added_count += 1
-        except Exception as add_error:
-            # Log malformed CIDRs but don't stop processing
-            error_count += 1
-            logging.debug(f"Failed to add CIDR '{cidr_string}' to SubnetTree: {add_error}")
-            continue
+    ARGS:
+        country_cidrs (list): One collapsed CIDR list per country, in country order
     
-    # Store the completed tree in the global variable
-    WORKER_TREE = subnet_tree
+    SIDE EFFECTS:
+        - May set the WORKER_* globals in the worker process
+    """
+    global WORKER_INPUT, WORKER_LINE_STARTS, WORKER_LINE_ENDS
     
-    # Log initialization results
-    logging.debug(f"Worker initialized: {added_count} networks in SubnetTree "
-                 f"({error_count} errors)")
+    # One compiled-kernel thread per worker process avoids oversubscribing cores
+    set_num_threads(1)
+    
+    if WORKER_STARTS is None:
+        _install_lookup(country_cidrs)
+    
+    if WORKER_INPUT is None:
+        WORKER_INPUT, WORKER_LINE_STARTS, WORKER_LINE_ENDS = load_ip_file_mmap(ALL_IPS_FROM_LISTS)
+    
+    # Load the compiled matcher now so batch timings exclude it
+    match_ips(WORKER_INPUT, WORKER_LINE_STARTS[:0], WORKER_LINE_ENDS[:0],
+              WORKER_STARTS, WORKER_ENDS, WORKER_TAGS, WORKER_BLOCK_INDEX)
+
+
+# Characters an address ipaddress accepts can be made of (hex digits for
+# IPv6, dots, colons, a /prefix or /netmask). Lines with anything else, such
+# as comments or hostnames, are rejected without parsing. A "%scope" suffix
+# fails here too, which is fine: scoped addresses never match anyway.
+_IP_TEXT_RE = re.compile(r'[0-9A-Fa-f.:/]+')
+
+
+def _lookup_unparsed_line(cleaned_ip):
+    """
+    Looks up a line the compiled parser rejected in the tagged ranges.
+    
+    This is the per-line path for anything that is not a canonical
+    dotted-quad IPv4 address or CIDR: IPv6 text, netmask-style CIDRs
+    (1.2.3.0/255.255.255.0) and the like. IPv4-mapped IPv6 addresses
+    (::ffff:1.2.3.4) match their IPv4 address; other IPv6 never matches
+    since the GeoIP data is IPv4-only.
+    
+    ARGS:
+        cleaned_ip (str): Stripped, non-empty input line
+    
+    RETURNS:
+        int or None: Tag of the matching range, None if no match or malformed
+    """
+    # Cheap shape check first, so junk lines don't cost a raised exception
+    if not _IP_TEXT_RE.fullmatch(cleaned_ip):
+        if _DEBUG:
+            logging.debug(f"Skipping malformed IP '{cleaned_ip}': unexpected characters")
+        return None
+    
+    try:
+        # Determine what IP address to check against the ranges
+        if '/' in cleaned_ip:
+            # This is a CIDR network - check the network address, not the CIDR string
+            ip_to_lookup = ipaddress.ip_network(cleaned_ip, strict=False).network_address
+        else:
+            # This is a single IP address - check it directly
+            ip_to_lookup = ipaddress.ip_address(cleaned_ip)
+    except ValueError as parse_error:
+        # Skip malformed IP addresses or CIDR blocks
+        if _DEBUG:
+            logging.debug(f"Skipping malformed IP '{cleaned_ip}': {parse_error}")
+        return None
+    
+    if ip_to_lookup.version == 6:
+        if ip_to_lookup.ipv4_mapped is None or ip_to_lookup.scope_id:
+            return None
+        ip_to_lookup = ip_to_lookup.ipv4_mapped
+    
+    # Same binary search as the compiled matcher. The key must be a uint32
+    # scalar: a Python int makes numpy convert the whole table on every call.
+    ip_value = int(ip_to_lookup)
+    range_index = int(np.searchsorted(WORKER_STARTS, np.uint32(ip_value), side='right')) - 1
+    if range_index >= 0 and ip_value <= WORKER_ENDS[range_index]:
+        return int(WORKER_TAGS[range_index])
+    return None
 
 
 def _process_ip_batch(ip_batch):
     """
-    Processes a batch of IP addresses/networks against the country filter.
+    Processes a batch of IP addresses/networks against every country at once.
     
     This is the core worker function that gets executed in parallel across
-    multiple processes. Each worker receives a batch of IP addresses and
-    checks them against the SubnetTree to determine if they belong to the
-    target country.
+    multiple processes. Each worker receives a range of line indexes into the
+    shared memory-mapped input, runs the compiled matcher over the whole
+    batch at once, and marks each hit for the countries its range is tagged
+    with. Only lines the compiled parser rejects fall back to per-line
+    Python; the matched text itself is read back from the mapping by the
+    main process, so no strings cross the process boundary.
     
     IP FORMAT HANDLING:
         - Single IPs: 192.168.1.1 → check directly
-        - CIDR networks: 192.168.1.0/24 → check network address
+        - CIDR networks: 192.168.1.0/24 → check network address, which the
+          compiled parser masks out as an integer (no ipaddress objects)
+        - IPv6 / unusual formats → per-line ipaddress fallback
         - Preserves original formatting in output
     
     ARGS:
-        ip_batch (list): List of IP strings to process (mix of IPs and CIDRs)
+        ip_batch (tuple): (first_line, last_line) - half-open line index range
     
     RETURNS:
-        list: IP strings that match the country filter (preserves original format)
+        tuple: (first_line, last_line, packed_hits, fallback_hits)
+            - packed_hits: np.packbits of a (country x line) boolean hit mask
+            - fallback_hits: (line index, stripped text) of lines matched by
+              the per-line fallback, whose text the main process cannot
+              rebuild from raw bytes
     
     ERROR HANDLING:
         - Skips malformed IPs/CIDRs without stopping
-        - Handles SubnetTree lookup exceptions
         - Continues processing even if some IPs fail
     
     PERFORMANCE:
-        - Each lookup is O(log n) thanks to SubnetTree
-        - Batch processing reduces inter-process communication overhead
-        - Memory efficient - processes one IP at a time
+        - Parsing and binary search run in compiled code, no per-IP objects
+        - Each IP is looked up once regardless of the number of countries
+        - Results are one bit per line and country instead of pickled strings
     """
-    global WORKER_TREE
-    
-    # Safety check: ensure the worker tree was initialized properly
-    if WORKER_TREE is None:
-        error_msg = "WORKER_TREE not initialized - worker setup failed"
+    # Safety check: ensure the worker lookup structures were initialized properly
+    if WORKER_STARTS is None:
+        error_msg = "WORKER_STARTS not initialized - worker setup failed"
         logging.error(error_msg)
         raise RuntimeError(error_msg)
     
-    # List to collect matching IPs (preserving original format)
-    country_matched_ips = []
+    first_line, last_line = ip_batch
+    line_starts = WORKER_LINE_STARTS[first_line:last_line]
+    line_ends = WORKER_LINE_ENDS[first_line:last_line]
     
-    # Statistics tracking
-    processed_count = 0
-    matched_count = 0
-    error_count = 0
+    # Parse and match the whole batch in one compiled call
+    line_tags = match_ips(WORKER_INPUT, line_starts, line_ends,
+                          WORKER_STARTS, WORKER_ENDS, WORKER_TAGS, WORKER_BLOCK_INDEX)
     
-    # Process each IP in the batch
-    for raw_ip_line in ip_batch:
-        # Clean up the input (remove whitespace)
-        cleaned_ip = raw_ip_line.strip()
-        
-        # Skip empty lines
-        if not cleaned_ip:
-            continue
-            
-        processed_count += 1
+    # Resolve lines the compiled parser rejected through the per-line fallback
+    fallback_hits = []
+    fallback_count = 0
+    
+    for line_index in np.flatnonzero(line_tags == UNPARSED):
+        line_bytes = WORKER_INPUT[line_starts[line_index]:line_ends[line_index]].tobytes()
+        cleaned_ip = line_bytes.decode(errors='replace').strip()
         
-        try:
-            # Determine what IP address to check against the tree
-            if '/' in cleaned_ip:
-                # This is a CIDR network (e.g., "192.168.1.0/24")
-                # We need to check the network address, not the CIDR string itself
-                network_obj = ipaddress.ip_network(cleaned_ip, strict=False)
-                ip_to_lookup = str(network_obj.network_address)
-                
-                logging.debug(f"CIDR '{cleaned_ip}' → checking network address '{ip_to_lookup}'")
-            else:
-                # This is a single IP address - check it directly
-                ip_to_lookup = cleaned_ip
-                
-        except (ipaddress.AddressValueError, ipaddress.NetmaskValueError, ValueError) as parse_error:
-            # Skip malformed IP addresses or CIDR blocks
-            error_count += 1
-            logging.debug(f"Skipping malformed IP '{cleaned_ip}': {parse_error}")
+        line_tag = _lookup_unparsed_line(cleaned_ip) if cleaned_ip else None
+        if line_tag is None:
+            line_tags[line_index] = NO_MATCH
             continue
         
-        try:
-            # Perform the SubnetTree lookup
-            # This checks if ip_to_lookup falls within any of our country networks
-            if ip_to_lookup in WORKER_TREE:
-                # IP matches! Add the ORIGINAL format to results
-                # This preserves CIDR notation if that's what was input
-                country_matched_ips.append(cleaned_ip)
-                matched_count += 1
-                logging.debug(f"MATCH: '{cleaned_ip}' (checked: '{ip_to_lookup}')")
-            else:
-                logging.debug(f"No match: '{cleaned_ip}' (checked: '{ip_to_lookup}')")
-                
-        except Exception as lookup_error:
-            # Handle any SubnetTree lookup errors (shouldn't happen with valid IPs)
-            error_count += 1
-            logging.debug(f"SubnetTree lookup failed for '{ip_to_lookup}': {lookup_error}")
-            continue
+        fallback_count += 1
+        line_tags[line_index] = line_tag
+        fallback_hits.append((first_line + int(line_index), cleaned_ip))
+    
+    # Expand each matched line's tag into its countries: one bit per line and country
+    matched_lines = np.flatnonzero(line_tags >= 0)
+    country_hits = np.zeros((WORKER_COUNTRY_COUNT, len(line_tags)), dtype=bool)
+    country_hits[:, matched_lines] = WORKER_TAG_MASK[line_tags[matched_lines]].T
     
     # Log batch processing results
-    logging.debug(f"Batch complete: {processed_count} processed, {matched_count} matched, "
-                 f"{error_count} errors")
+    if _DEBUG:
+        logging.debug(f"Batch complete: {len(line_tags)} processed, {len(matched_lines)} matched, "
+                      f"{fallback_count} via per-line fallback")
     
-    return country_matched_ips
+    return first_line, last_line, np.packbits(country_hits, axis=1), fallback_hits
+
+
+def _timed_process_ip_batch(ip_batch):
+    """
+    Runs _process_ip_batch and also reports how long it took in the worker.
+    
+    ARGS:
+        ip_batch (tuple): (first_line, last_line) - half-open line index range
+    
+    RETURNS:
+        tuple: (elapsed_seconds, batch_result)
+    """
+    batch_start_time = time.perf_counter()
+    batch_result = _process_ip_batch(ip_batch)
+    return time.perf_counter() - batch_start_time, batch_result
+
+
+def _read_matched_lines(line_indexes, fallback_texts):
+    """
+    Copies the matched input lines into a ready-to-write output block.
+    
+    The lines are copied out of the memory-mapped input in one compiled call,
+    already trimmed and newline-terminated, so the block can go straight to
+    the output file without per-line strings. Lines matched through the
+    per-line fallback take their text from the worker instead.
+    
+    ARGS:
+        line_indexes (np.ndarray): Sorted indexes of matched input lines
+        fallback_texts (dict): Line index → stripped text for fallback matches
+    
+    RETURNS:
+        bytes: Matching IPs in input order, one per line, original format preserved
+    """
+    ip_block = gather_lines(WORKER_INPUT, WORKER_LINE_STARTS[line_indexes],
+                            WORKER_LINE_ENDS[line_indexes]).tobytes()
+    
+    fallback_positions = np.flatnonzero(np.isin(line_indexes, list(fallback_texts)))
+    if fallback_positions.size:
+        # Rare: splice the worker's decoded text over the raw bytes
+        ip_lines = ip_block.split(b"\n")
+        for line_position in fallback_positions:
+            ip_lines[line_position] = fallback_texts[int(line_indexes[line_position])].encode()
+        ip_block = b"\n".join(ip_lines)
+    
+    return ip_block
 
 
 # =============================================================================
@@ -568,151 +781,465 @@ def generate_mermaid_pie_chart(country_statistics, total_input_ips, top_n=19):
 # MULTI-COUNTRY FILTERING FUNCTIONS
 # =============================================================================
 
-def process_single_country(iso_code, country_name, suffix, geoip_dataframe, input_ip_list, optimal_workers):
+def process_single_country(iso_code, country_name, suffix, country_networks):
     """
-    Process IPs for a single country and return filtered results.
+    Optimize one country's GeoIP networks and start its statistics.
+    
+    Matching itself happens for all countries together in filter_all_countries;
+    this only prepares the country's collapsed CIDR list.
     
     ARGS:
         iso_code (str): Country ISO code (e.g., 'US')
         country_name (str): Full country name (e.g., 'United States')
         suffix (str): Variable suffix (e.g., '1', '2', or '' for legacy)
-        geoip_dataframe (pd.DataFrame): GeoIP data
-        input_ip_list (list): List of IPs to filter
-        optimal_workers (int): Number of worker processes to use
+        country_networks (np.ndarray): CIDR strings of this country's GeoIP networks
         
     RETURNS:
-        tuple: (filtered_ips_list, stats_dict)
+        tuple: (optimized_cidrs, stats_dict) - 'ips_matched' and 'output_file'
+               are filled in once the input has been filtered
     """
     logging.info(f"=== Processing {country_name} ({iso_code}) ===")
-    
-    # Filter networks for this country
-    country_mask = (
-        (geoip_dataframe.get('country_iso_code') == iso_code) | 
-        (geoip_dataframe.get('country_name') == country_name)
-    )
-    
-    country_networks = (geoip_dataframe[country_mask]['network']
-                       .dropna()
-                       .astype(str)
-                       .tolist())
-    
     logging.info(f"Found {len(country_networks)} networks for {country_name}")
     
+    stats = {
+        'iso_code': iso_code,
+        'country_name': country_name,
+        'suffix': suffix,
+        'networks_found': len(country_networks),
+        'networks_optimized': 0,
+        'ips_matched': 0,
+        'output_file': None
+    }
+    
     if len(country_networks) == 0:
         logging.warning(f"No networks found for {country_name} ({iso_code})")
-        return [], {
-            'iso_code': iso_code,
-            'country_name': country_name,
-            'suffix': suffix,
-            'networks_found': 0,
-            'networks_optimized': 0,
-            'ips_matched': 0,
-            'output_file': None
-        }
+        return [], stats
     
     # Optimize networks
     optimized_cidrs = collapse_networks(country_networks)
+    stats['networks_optimized'] = len(optimized_cidrs)
     
     if len(optimized_cidrs) == 0:
         logging.warning(f"Network optimization resulted in empty list for {country_name}")
-        return [], {
-            'iso_code': iso_code,
-            'country_name': country_name,
-            'suffix': suffix,
-            'networks_found': len(country_networks),
-            'networks_optimized': 0,
-            'ips_matched': 0,
-            'output_file': None
+    
+    return optimized_cidrs, stats
+
+
+def read_geoip_networks(csv_path, country_configs):
+    """
+    Reads the GeoIP CSV and groups its networks by (ISO code, country name).
+    
+    Only the three columns used for filtering are parsed. Rows are first
+    narrowed to those whose ISO code or country name
+    belongs to a configured country, then grouped once so each country is
+    selected from a handful of groups instead of a full table scan. With
+    pyarrow installed the file is read into an Arrow table and filtered and
+    grouped there; otherwise the rows are streamed through the csv module
+    and only matching networks are kept. Gzip is inferred from the name.
+    
+    ARGS:
+        csv_path (str): GeoIP CSV file, plain or .gz
+        country_configs (list): (iso_code, country_name, suffix) tuples
+    
+    RETURNS:
+        dict: (iso_code, country_name) → np.ndarray of network strings
+    
+    RAISES:
+        KeyError: If a required column is missing
+        OSError / EOFError / zlib.error: If the file or its gzip stream cannot be read
+        ValueError / csv.Error: If the file cannot be parsed
+    """
+    geoip_columns = ['network', 'country_iso_code', 'country_name']
+    iso_codes = sorted({iso_code for iso_code, _, _ in country_configs})
+    country_names = sorted({country_name for _, country_name, _ in country_configs})
+    
+    if HAS_PYARROW:
+        geoip_table = pa_csv.read_csv(
+            csv_path,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=geoip_columns,
+                column_types={column: pa.string() for column in geoip_columns}
+            )
+        )
+        logging.info(f"GeoIP database loaded: {geoip_table.num_rows} total entries")
+        
+        country_rows = pc.or_kleene(
+            pc.is_in(geoip_table['country_iso_code'], value_set=pa.array(iso_codes, pa.string())),
+            pc.is_in(geoip_table['country_name'], value_set=pa.array(country_names, pa.string()))
+        )
+        geoip_table = geoip_table.filter(pc.and_kleene(country_rows, pc.is_valid(geoip_table['network'])))
+        grouped_table = geoip_table.group_by(['country_iso_code', 'country_name']).aggregate(
+            [('network', 'list')]
+        )
+        return {
+            (group_iso, group_name): np.asarray(group_networks, dtype=object)
+            for group_iso, group_name, group_networks in zip(
+                grouped_table['country_iso_code'].to_pylist(),
+                grouped_table['country_name'].to_pylist(),
+                grouped_table['network_list'].to_pylist()
+            )
         }
     
-    # Calculate batches for this country
-    total_input_ips = len(input_ip_list)
-    batches_per_worker = 4
-    total_desired_batches = optimal_workers * batches_per_worker
-    batch_size = max(1, total_input_ips // total_desired_batches)
+    # Without pyarrow, stream the rows with the csv module and keep only the
+    # networks of configured countries; no table is ever materialized
+    wanted_isos = set(iso_codes)
+    wanted_names = set(country_names)
+    networks_by_country = {}
+    row_count = 0
+    
+    open_csv = gzip.open if str(csv_path).endswith('.gz') else open
+    with open_csv(csv_path, 'rt', encoding='utf-8-sig', newline='') as csv_file:
+        csv_rows = csv.reader(csv_file)
+        header = next(csv_rows, [])
+        
+        missing_columns = [column for column in geoip_columns if column not in header]
+        if missing_columns:
+            raise KeyError(f"Columns {missing_columns} do not exist in CSV file")
+        network_column, iso_column, name_column = (header.index(column) for column in geoip_columns)
+        
+        for row in csv_rows:
+            # Blank lines are skipped, as pyarrow does
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValueError(f"Expected {len(header)} columns, got {len(row)}: {row}")
+            
+            row_count += 1
+            if row[iso_column] in wanted_isos or row[name_column] in wanted_names:
+                group_key = (row[iso_column], row[name_column])
+                networks_by_country.setdefault(group_key, []).append(row[network_column])
+    
+    logging.info(f"GeoIP database loaded: {row_count} total entries")
+    
+    return {
+        group_key: np.asarray(networks, dtype=object)
+        for group_key, networks in networks_by_country.items()
+    }
+
+
+def _country_cidrs_cache_path(country_configs):
+    """
+    Builds the cache file path for a GeoIP file and country configuration.
+    
+    The key is a SHA-1 over CACHE_FORMAT_VERSION, the GeoIP CSV contents and
+    the configured (ISO code, country name) pairs. The contents are hashed
+    rather than the file's mtime because the CSV can be downloaded again
+    (e.g. on a fresh checkout), so an unchanged database must still map to
+    the same key.
+    
+    ARGS:
+        country_configs (list): Tuples (iso_code, country_name, suffix)
+    
+    RETURNS:
+        Path: Cache file for this input, inside GEOIP_CACHE_DIR
+    """
+    cache_hasher = hashlib.sha1(f"country-cidrs-v{CACHE_FORMAT_VERSION}\0".encode())
+    
+    # Hash the CSV in fixed-size blocks so memory use stays flat
+    with open(geoip_csv_file() or GEOIP_CSV_PATH, 'rb') as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b''):
+            cache_hasher.update(block)
+    
+    # Names take part in matching too, so they belong in the key
+    for iso_code, country_name, _ in country_configs:
+        cache_hasher.update(f"\0{iso_code}\0{country_name}".encode())
+    
+    return Path(GEOIP_CACHE_DIR) / f"country-cidrs-{cache_hasher.hexdigest()}.pkl"
+
+
+def load_country_cidrs(country_configs):
+    """
+    Loads the GeoIP database and collapses the networks of every country.
+    
+    Results are cached on disk (see GEOIP_CACHE_DIR); when the GeoIP data
+    and the country configuration are unchanged, the cached CIDR lists are
+    returned without parsing the CSV or collapsing any networks.
+    
+    ARGS:
+        country_configs (list): Tuples (iso_code, country_name, suffix)
+    
+    RETURNS:
+        tuple: (country_cidrs, country_statistics) - one collapsed CIDR list
+               and one statistics dict per country, in country order
+    
+    ERROR HANDLING:
+        - Exits if the CSV cannot be read or lacks required columns
+        - Cache read/write problems are logged and otherwise ignored
+        - After a successful cache write, older cache files are deleted
+    """
+    # Try the cache first
+    try:
+        cache_path = _country_cidrs_cache_path(country_configs)
+    except OSError as hash_error:
+        logging.error(f"Failed to load GeoIP CSV file: {hash_error}")
+        raise SystemExit(1)
+    
+    if cache_path.exists():
+        try:
+            country_cidrs, country_statistics = pickle.loads(cache_path.read_bytes())
+            logging.info(f"Loaded collapsed country networks from cache: {cache_path}")
+            return country_cidrs, country_statistics
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as cache_error:
+            logging.warning(f"Ignoring unreadable cache file {cache_path}: {cache_error}")
+    
+    try:
+        networks_by_country = read_geoip_networks(geoip_csv_file() or GEOIP_CSV_PATH, country_configs)
+        
+    except KeyError as column_error:
+        logging.error("GeoIP CSV missing required 'network', 'country_iso_code' or 'country_name' column")
+        logging.error(f"Details: {column_error}")
+        raise SystemExit(1)
+    except (OSError, EOFError, zlib.error, csv.Error, ValueError) as csv_error:
+        # Arrow parse errors, malformed rows and bad UTF-8 are ValueErrors;
+        # unreadable, truncated or corrupt .gz files raise OSError, EOFError
+        # or zlib.error; the csv module raises csv.Error (e.g. oversized fields)
+        logging.error(f"Failed to load GeoIP CSV file: {csv_error}")
+        raise SystemExit(1)
+    
+    country_statistics = []
+    country_cidrs = []
+    
+    for iso_code, country_name, suffix in country_configs:
+        # Networks whose ISO code OR country name matches this country
+        country_networks = [
+            networks for (group_iso, group_name), networks in networks_by_country.items()
+            if group_iso == iso_code or group_name == country_name
+        ]
+        country_networks = np.concatenate(country_networks) if country_networks else np.array([], dtype=object)
+        
+        optimized_cidrs, stats = process_single_country(
+            iso_code, country_name, suffix, country_networks
+        )
+        
+        country_cidrs.append(optimized_cidrs)
+        country_statistics.append(stats)
+    
+    # Store the result for the next run; write then rename so readers never see a partial file
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix('.tmp')
+        temp_path.write_bytes(pickle.dumps((country_cidrs, country_statistics), protocol=pickle.HIGHEST_PROTOCOL))
+        os.replace(temp_path, cache_path)
+        logging.info(f"Cached collapsed country networks: {cache_path}")
+    except OSError as cache_error:
+        logging.warning(f"Failed to write cache file {cache_path}: {cache_error}")
+        return country_cidrs, country_statistics
+    
+    # Keep only the file just written; files for older GeoIP data, country
+    # configurations or cache formats would otherwise pile up in /data
+    for stale_path in cache_path.parent.glob('country-cidrs-*.pkl'):
+        if stale_path != cache_path:
+            try:
+                stale_path.unlink()
+            except OSError as cache_error:
+                logging.warning(f"Failed to remove old cache file {stale_path}: {cache_error}")
+    
+    return country_cidrs, country_statistics
+
+
+def _collect_batch_results(batch_results, country_count):
+    """
+    Merges batch hit masks into one block of matching IPs per country.
+    
+    ARGS:
+        batch_results (iterable): _process_ip_batch results, in input order
+        country_count (int): Number of configured countries
+    
+    RETURNS:
+        list: One bytes block per country (see _read_matched_lines)
+    """
+    country_line_indexes = [[] for _ in range(country_count)]
+    fallback_texts = {}
+    
+    for first_line, last_line, packed_hits, fallback_hits in batch_results:
+        country_hits = np.unpackbits(packed_hits, axis=1, count=last_line - first_line)
+        for country_index, line_hits in enumerate(country_hits):
+            country_line_indexes[country_index].append(first_line + np.flatnonzero(line_hits))
+        fallback_texts.update(fallback_hits)
+    
+    # Read the matching lines back out of the mapped input, per country
+    return [
+        _read_matched_lines(np.concatenate(line_indexes), fallback_texts)
+        for line_indexes in country_line_indexes
+    ]
+
+
+def filter_all_countries(country_cidrs, input_ip_lines, optimal_workers):
+    """
+    Filter the input IPs against every country in a single pass.
+    
+    The combined tagged lookup is built once in this process, then a single
+    worker pool scans the whole input; forked workers share the lookup and
+    the memory-mapped input copy-on-write. Each batch result is split by
+    country and merged here.
+    
+    ARGS:
+        country_cidrs (list): One collapsed CIDR list per country, in country order
+        input_ip_lines (tuple): (data, line_starts, line_ends) from load_ip_file_mmap
+        optimal_workers (int): Number of worker processes to use; 0 matches
+                               the whole input in this process instead
+        
+    RETURNS:
+        list: One bytes block of matching IPs per country, one IP per line,
+              in input order
+    """
+    global WORKER_INPUT, WORKER_LINE_STARTS, WORKER_LINE_ENDS
+    
+    # Build the combined lookup once; forked workers inherit it with the input
+    _install_lookup(country_cidrs)
+    WORKER_INPUT, WORKER_LINE_STARTS, WORKER_LINE_ENDS = input_ip_lines
+    
+    total_input_ips = len(WORKER_LINE_STARTS)
+    
+    if optimal_workers == 0:
+        # Small input: one batch in this process. No pool is forked later,
+        # so the kernel may use all of its threads here.
+        return _collect_batch_results(
+            [_process_ip_batch((0, total_input_ips))], len(country_cidrs)
+        )
     
-    # Split input IPs into batches
-    ip_batches = []
-    for start_idx in range(0, total_input_ips, batch_size):
-        end_idx = min(start_idx + batch_size, total_input_ips)
-        batch = input_ip_list[start_idx:end_idx]
-        ip_batches.append(batch)
+    calibration_end = min(CALIBRATION_LINES, total_input_ips)
     
-    # Process batches in parallel
-    filtered_ips = []
+    # Fork shares the lookup built above without pickling; other platforms
+    # fall back to their default start method and rebuild it per worker
+    mp_context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
     
     try:
         with ProcessPoolExecutor(
             max_workers=optimal_workers,
+            mp_context=mp_context,
             initializer=_init_worker,
-            initargs=(optimized_cidrs,)
+            initargs=(country_cidrs,)
         ) as process_executor:
             
-            batch_results = process_executor.map(_process_ip_batch, ip_batches)
+            # Calibrate: time the first lines in a worker (its result is kept)
+            calibration_seconds, calibration_result = process_executor.submit(
+                _timed_process_ip_batch, (0, calibration_end)
+            ).result()
+            
+            # Size batches to the target duration, but keep every worker busy
+            remaining_ips = total_input_ips - calibration_end
+            lines_per_second = calibration_end / max(calibration_seconds, 1e-6)
+            batch_size = int(lines_per_second * BATCH_TARGET_SECONDS)
+            batch_size = min(max(batch_size, MIN_BATCH_LINES), MAX_BATCH_LINES)
+            batch_size = max(1, min(batch_size, -(-remaining_ips // optimal_workers)))
+            
+            if remaining_ips > 0:
+                logging.info(f"Calibrated batch size: {batch_size} lines "
+                             f"({calibration_end} lines in {calibration_seconds * 1000:.1f} ms)")
+            
+            # Batches are just line index ranges; workers slice the shared offsets
+            ip_batches = (
+                (start_idx, min(start_idx + batch_size, total_input_ips))
+                for start_idx in range(calibration_end, total_input_ips, batch_size)
+            )
+            
+            # Hand batches to workers in chunks to amortize IPC round-trips
+            total_batches = -(-remaining_ips // batch_size)
+            chunksize = max(1, total_batches // (optimal_workers * 4))
             
-            for batch_result in batch_results:
-                filtered_ips.extend(batch_result)
+            # map() keeps results in input order, which the output files rely on
+            batch_results = process_executor.map(_process_ip_batch, ip_batches, chunksize=chunksize)
+            
+            filtered_ips = _collect_batch_results(
+                itertools.chain([calibration_result], batch_results), len(country_cidrs)
+            )
                 
     except Exception as parallel_error:
-        logging.error(f"Parallel processing failed for {country_name}: {parallel_error}")
-        logging.info("Falling back to single-threaded processing...")
+        logging.error(f"Parallel processing failed: {parallel_error}")
+        logging.info("Falling back to in-process processing...")
         
-        # Single-threaded fallback
-        fallback_tree = SubnetTree.SubnetTree()
-        for cidr in optimized_cidrs:
-            try:
-                fallback_tree[cidr] = True
-            except Exception:
-                continue
-        
-        for raw_ip in input_ip_list:
-            cleaned_ip = raw_ip.strip()
-            if not cleaned_ip:
-                continue
-                
-            try:
-                if '/' in cleaned_ip:
-                    network_obj = ipaddress.ip_network(cleaned_ip, strict=False)
-                    ip_to_check = str(network_obj.network_address)
-                else:
-                    ip_to_check = cleaned_ip
-                    
-            except Exception:
-                continue
-            
-            try:
-                if ip_to_check in fallback_tree:
-                    filtered_ips.append(cleaned_ip)
-            except Exception:
-                continue
+        # In-process fallback: the same compiled batch path over the whole
+        # input as one batch. The pool is gone and nothing forks after this,
+        # so the kernel may use all of its threads here.
+        filtered_ips = _collect_batch_results(
+            [_process_ip_batch((0, total_input_ips))], len(country_cidrs)
+        )
+    
+    return filtered_ips
+
+
+def combine_ip_blocks(ip_blocks):
+    """
+    Merge per-country IP blocks into one deduplicated block in address order.
+    
+    Instead of hashing every line into a set of strings, each line is keyed
+    by its parsed address and prefix length in compiled code. A key stands
+    for exactly one IPv4 line, so np.unique over the keys removes duplicates
+    and sorts numerically in one native pass ("9.9.9.9" before "10.0.0.1").
+    The few remaining lines that are not canonical IPv4 (e.g. IPv4-mapped
+    IPv6 addresses) are deduplicated as text and appended in byte order.
+    
+    ARGS:
+        ip_blocks (list): bytes blocks, one IP per line, newline-terminated
     
+    RETURNS:
+        tuple: (combined_block, unique_count) - bytes block and its line count
+    """
+    block_data = np.frombuffer(b"".join(ip_blocks), dtype=np.uint8)
+    line_starts, line_ends = split_lines(block_data)
+    sort_keys = ip_sort_keys(block_data, line_starts, line_ends)
+    
+    # First occurrence of each distinct address line, in key order
+    is_ipv4 = sort_keys != UNPARSED_SORT_KEY
+    ipv4_lines = np.flatnonzero(is_ipv4)
+    _, first_lines = np.unique(sort_keys[ipv4_lines], return_index=True)
+    ipv4_lines = ipv4_lines[first_lines]
+    ipv4_block = gather_lines(block_data, line_starts[ipv4_lines], line_ends[ipv4_lines]).tobytes()
+    
+    other_lines = sorted({
+        block_data[line_start:line_end].tobytes()
+        for line_start, line_end in zip(line_starts[~is_ipv4], line_ends[~is_ipv4])
+    })
+    
+    combined_block = ipv4_block + b"".join(line + b"\n" for line in other_lines)
+    return combined_block, ipv4_lines.size + len(other_lines)
+
+
+def write_ip_lines(output_path, ip_block):
+    """
+    Write a block of newline-terminated IPs to a file in a single write call.
+    
+    The block is written as-is, so emitting large result sets is a single
+    buffer copy rather than millions of small writes.
+    
+    ARGS:
+        output_path (str): File to create or overwrite
+        ip_block (bytes): IPs, one per line, each followed by a newline
+    
+    RAISES:
+        IOError: If the file cannot be written
+    """
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'wb') as output_file:
+        output_file.write(ip_block)
+
+
+def write_country_file(iso_code, ip_block):
+    """
+    Write one country's matching IPs to its output file.
+    
+    ARGS:
+        iso_code (str): Country ISO code (e.g., 'US')
+        ip_block (bytes): Matching IPs, one per line (see _read_matched_lines)
+        
+    RETURNS:
+        str or None: Output filename, or None if writing failed
+    """
     # Generate output filename
     output_filename = f"aggregated-{iso_code.lower()}-only.txt"
     output_path = f"/data/output/{output_filename}"
     
     # Write results to file
     try:
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, 'w') as output_file:
-            for ip_address in filtered_ips:
-                output_file.write(f"{ip_address}\n")
-        logging.info(f"Written {len(filtered_ips)} IPs to {output_path}")
+        write_ip_lines(output_path, ip_block)
+        written_count = ip_block.count(b"\n")
+        logging.info(f"Written {written_count} IPs to {output_path}")
     except IOError as write_error:
         logging.error(f"Failed to write {output_path}: {write_error}")
         output_filename = None
     
-    # Return results and statistics
-    stats = {
-        'iso_code': iso_code,
-        'country_name': country_name,
-        'suffix': suffix,
-        'networks_found': len(country_networks),
-        'networks_optimized': len(optimized_cidrs),
-        'ips_matched': len(filtered_ips),
-        'output_file': output_filename
-    }
-    
-    return filtered_ips, stats
+    return output_filename
 
 
 # =============================================================================
@@ -750,6 +1277,12 @@ def filter_multi_country_ips():
     # STAGE 2: GEOIP DATA ACQUISITION
     # =========================================================================
     
+    # Index the input file in the background while the GeoIP data is
+    # downloaded and parsed; numpy releases the GIL for the big array passes.
+    # The thread is joined in Stage 3, well before any worker is forked.
+    input_loader = ThreadPoolExecutor(max_workers=1)
+    input_future = input_loader.submit(load_ip_file_mmap, ALL_IPS_FROM_LISTS)
+    
     logging.info("Stage 1: Acquiring GeoIP database...")
     download_geoip_file()
     
@@ -759,18 +1292,7 @@ def filter_multi_country_ips():
     
     logging.info("Stage 2: Loading and validating GeoIP database...")
     
-    try:
-        geoip_dataframe = pd.read_csv(GEOIP_CSV_PATH)
-        logging.info(f"GeoIP database loaded: {len(geoip_dataframe)} total entries")
-        
-    except (FileNotFoundError, pd.errors.EmptyDataError, pd.errors.ParserError) as csv_error:
-        logging.error(f"Failed to load GeoIP CSV file: {csv_error}")
-        raise SystemExit(1)
-    
-    if 'network' not in geoip_dataframe.columns:
-        logging.error("GeoIP CSV missing required 'network' column")
-        logging.error(f"Available columns: {list(geoip_dataframe.columns)}")
-        raise SystemExit(1)
+    country_cidrs, country_statistics = load_country_cidrs(country_configs)
     
     # =========================================================================
     # STAGE 4: INPUT DATA LOADING
@@ -779,8 +1301,8 @@ def filter_multi_country_ips():
     logging.info("Stage 3: Loading input IP list...")
     
     try:
-        with open(ALL_IPS_FROM_LISTS, 'r') as input_file:
-            input_ip_list = [line.rstrip('\n') for line in input_file if line.strip()]
+        # Mapped file instead of a Python string per line (loaded since Stage 1)
+        input_ip_lines = input_future.result()
             
     except FileNotFoundError:
         logging.error(f"Input IP file not found: {ALL_IPS_FROM_LISTS}")
@@ -788,8 +1310,10 @@ def filter_multi_country_ips():
     except IOError as io_error:
         logging.error(f"Failed to read input file: {io_error}")
         raise SystemExit(1)
+    finally:
+        input_loader.shutdown()
     
-    total_input_ips = len(input_ip_list)
+    total_input_ips = len(input_ip_lines[1])
     logging.info(f"Loaded {total_input_ips} IP entries for processing")
     
     if total_input_ips == 0:
@@ -803,33 +1327,38 @@ def filter_multi_country_ips():
     logging.info("Stage 4: Setting up parallel processing...")
     
     system_cpu_count = mp.cpu_count()
-    optimal_workers = min(NUM_WORKERS_OVERRIDE or system_cpu_count, 4)
     
-    logging.info(f"Using {optimal_workers} worker processes")
+    # An explicit NUM_WORKERS always gets a pool, even for small inputs
+    if NUM_WORKERS_OVERRIDE:
+        optimal_workers = NUM_WORKERS_OVERRIDE
+        logging.info(f"Using {optimal_workers} worker processes (NUM_WORKERS override)")
+    elif total_input_ips < INLINE_MAX_IPS:
+        optimal_workers = 0
+        logging.info(f"Input below {INLINE_MAX_IPS} IPs: matching in this process without a worker pool")
+    else:
+        optimal_workers = max(1, min(system_cpu_count, -(-total_input_ips // MIN_IPS_PER_WORKER)))
+        logging.info(f"Using {optimal_workers} worker processes "
+                     f"({system_cpu_count} CPUs, {total_input_ips} input IPs)")
     
     # =========================================================================
-    # STAGE 6: PROCESS EACH COUNTRY
+    # STAGE 6: FILTER ALL COUNTRIES WITH ONE WORKER POOL
     # =========================================================================
     
     logging.info("Stage 5: Processing countries...")
     
-    all_country_results = []
-    country_statistics = []
-    all_filtered_ips = set()  # Use set to avoid duplicates in combined file
+    # One pass over the input for all countries at once; each country's
+    # matches come back as a block that is written out unchanged
+    country_ip_blocks = filter_all_countries(
+        country_cidrs, input_ip_lines, optimal_workers
+    )
     
-    for iso_code, country_name, suffix in country_configs:
-        filtered_ips, stats = process_single_country(
-            iso_code, country_name, suffix, geoip_dataframe, 
-            input_ip_list, optimal_workers
-        )
-        
-        all_country_results.append((iso_code, country_name, filtered_ips))
-        country_statistics.append(stats)
+    for stats, optimized_cidrs, ip_block in zip(country_statistics, country_cidrs, country_ip_blocks):
+        # Countries without networks get no output file
+        if optimized_cidrs:
+            stats['output_file'] = write_country_file(stats['iso_code'], ip_block)
+        stats['ips_matched'] = ip_block.count(b"\n")
         
-        # Add to combined set (automatically deduplicates)
-        all_filtered_ips.update(filtered_ips)
-        
-        logging.info(f"Completed {country_name}: {len(filtered_ips)} IPs")
+        logging.info(f"Completed {stats['country_name']}: {stats['ips_matched']} IPs")
     
     # =========================================================================
     # STAGE 7: CREATE COMBINED MULTI-COUNTRY FILE
@@ -847,13 +1376,13 @@ def filter_multi_country_ips():
     combined_filename = f"aggregated-{combined_suffix}-combined.txt"
     combined_path = f"/data/output/{combined_filename}"
     
+    # Deduplicate across countries and sort by address
+    combined_block, combined_count = combine_ip_blocks(country_ip_blocks)
+    
     # Write combined file
     try:
-        Path(combined_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(combined_path, 'w') as combined_file:
-            for ip_address in sorted(all_filtered_ips):  # Sort for consistency
-                combined_file.write(f"{ip_address}\n")
-        logging.info(f"Written {len(all_filtered_ips)} unique IPs to {combined_path}")
+        write_ip_lines(combined_path, combined_block)
+        logging.info(f"Written {combined_count} unique IPs to {combined_path}")
     except IOError as write_error:
         logging.error(f"Failed to write combined file: {write_error}")
         combined_filename = None
@@ -873,7 +1402,7 @@ def filter_multi_country_ips():
     try:
         with open(stats_path, 'w') as stats_file:
             stats_file.write("# Multi-Country IP Aggregation Statistics\n\n")
-            stats_file.write(f"**Last Updated:** {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n")
+            stats_file.write(f"**Last Updated:** {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n")
             
             # Add Mermaid pie chart
             stats_file.write("## 📈 Country Distribution\n\n")
@@ -884,11 +1413,11 @@ def filter_multi_country_ips():
             stats_file.write("## Overall Summary\n\n")
             stats_file.write(f"- **Total Input IPs:** {total_input_ips:,}\n")
             stats_file.write(f"- **Countries Processed:** {len(country_configs)}\n")
-            stats_file.write(f"- **Combined Unique IPs:** {len(all_filtered_ips):,}\n")
+            stats_file.write(f"- **Combined Unique IPs:** {combined_count:,}\n")
             if combined_filename:
                 stats_file.write(f"- **Combined Output File:** `{combined_filename}`\n")
             
-            combined_percentage = (len(all_filtered_ips) / total_input_ips * 100) if total_input_ips > 0 else 0
+            combined_percentage = (combined_count / total_input_ips * 100) if total_input_ips > 0 else 0
             stats_file.write(f"- **Overall Filter Rate:** {combined_percentage:.2f}%\n\n")
             
             # Per-country breakdown
@@ -926,16 +1455,16 @@ def filter_multi_country_ips():
         logging.error(f"Failed to write statistics file: {stats_error}")
     
     # =========================================================================
-    # STAGE 9: CLEANUP AND FINAL REPORTING
+    # STAGE 9: FINAL REPORTING
     # =========================================================================
     
-    logging.info("Stage 8: Final reporting and cleanup...")
+    logging.info("Stage 8: Final reporting...")
     
     # Console summary
     logging.info("=== MULTI-COUNTRY FILTERING RESULTS ===")
     logging.info(f"Input IPs: {total_input_ips:,}")
     logging.info(f"Countries: {len(country_configs)}")
-    logging.info(f"Combined Unique IPs: {len(all_filtered_ips):,}")
+    logging.info(f"Combined Unique IPs: {combined_count:,}")
     logging.info(f"Overall Filter Rate: {combined_percentage:.2f}%")
     
     logging.info("\nPer-Country Summary:")
@@ -943,16 +1472,6 @@ def filter_multi_country_ips():
         filter_rate = (stats['ips_matched'] / total_input_ips * 100) if total_input_ips > 0 else 0
         logging.info(f"  {stats['country_name']} ({stats['iso_code']}): {stats['ips_matched']:,} IPs ({filter_rate:.2f}%)")
     
-    # Clean up GeoIP directory
-    geoip_directory = Path(GEOIP_CSV_PATH).parent
-    if geoip_directory.exists() and geoip_directory.is_dir():
-        try:
-            logging.info(f"Cleaning up GeoIP directory: {geoip_directory}")
-            shutil.rmtree(geoip_directory)
-            logging.info("GeoIP directory removed successfully")
-        except Exception as cleanup_error:
-            logging.warning(f"Failed to remove GeoIP directory: {cleanup_error}")
-    
     logging.info("=== MULTI-COUNTRY IP FILTERING PROCESS COMPLETED ===")
 
 
@@ -966,8 +1485,9 @@ if __name__ == "__main__":
     """
     
     # Configure logging for informative output
+    # FILTER_IPS_DEBUG=1 also enables the guarded per-IP debug messages
     logging.basicConfig(
-        level=logging.INFO,
+        level=logging.DEBUG if _DEBUG else logging.INFO,
         format='[%(levelname)s] %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )